@@ -1,24 +1,52 @@
 import streamlit as st
+import csv
+import io
 import json
 import os
 from datetime import datetime
-import pandas as pd
 import hashlib
+from bisect import bisect_left
+import hmac
+from html import escape
+import logging
+import queue
+import sys
+import threading
+import time
 from pathlib import Path
+import httpx
+from postgrest.exceptions import APIError
 from supabase import create_client
 
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps_bytes = orjson.dumps
+except ImportError:  # stdlib fallback; json.loads accepts bytes too
+    json_loads = json.loads
+
+    def json_dumps_bytes(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+logger = logging.getLogger(__name__)
+
 st.set_page_config(page_title="Power Annotation", layout="wide")
 
 # Password gate
 if "auth_ok" not in st.session_state:
     st.session_state.auth_ok = False
 
-app_pw = st.secrets.get("APP_PASSWORD")
+def password_digest(pw: str) -> bytes:
+    return hashlib.blake2b(pw.encode("utf-8"), digest_size=16).digest()
 
+# Secrets are only read while locked; authenticated reruns skip this block.
 if not st.session_state.auth_ok:
+    app_pw = st.secrets.get("APP_PASSWORD")
     st.title("Power Annotation")
     pwd = st.text_input("Password", type="password")
-    if pwd and pwd == app_pw:
+    # Compare fixed-size digests in constant time.
+    if pwd and app_pw and hmac.compare_digest(password_digest(pwd), password_digest(app_pw)):
         st.session_state.auth_ok = True
         st.rerun()
     elif pwd:
@@ -28,13 +56,14 @@ if not st.session_state.auth_ok:
 
 def make_case_id(c: dict, idx: int) -> str:
     # Prefer stable IDs from the current dialogue-generator format.
-    meta = c.get("meta", {}) if isinstance(c.get("meta"), dict) else {}
-    scenario_id = (
-        meta.get("topic_id")
-        or (meta.get("scenario", {}) or {}).get("id")
-        if isinstance(meta.get("scenario"), dict)
-        else meta.get("topic_id")
-    )
+    # normalize_case has already coerced c["meta"] to a dict.
+    meta = c["meta"]
+    scenario_id = meta.get("topic_id")
+    if not scenario_id:
+        try:
+            scenario_id = meta["scenario"].get("id")
+        except (KeyError, AttributeError):
+            pass  # no scenario dict; keep topic_id
     scenario_index = meta.get("scenario_index")
     rel = meta.get("relationship_type", "Unknown")
     n1 = meta.get("name1", "")
@@ -42,13 +71,35 @@ def make_case_id(c: dict, idx: int) -> str:
 
     base = f"{scenario_id}|{scenario_index}|{rel}|{n1}|{n2}".strip()
     if base and base not in {"None|None|Unknown||", "None|Unknown||"}:
-        h = hashlib.md5(base.encode("utf-8")).hexdigest()[:10]
+        # md5 must stay: annotations in Supabase are keyed by these ids.
+        h = hashlib.md5(base.encode("utf-8"), usedforsecurity=False).hexdigest()[:10]
         return f"case_{h}"
 
     # fallback: stable-ish by index
     return f"idx_{idx}"
 
 
+def _parse_raw_str(raw: str) -> dict:
+    try:
+        parsed = json_loads(raw)
+    except json.JSONDecodeError:
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+def _empty_raw(raw) -> dict:
+    return {}
+
+# type(raw) -> fixer returning a dict; anything else (None, lists, ...) -> {}
+_RAW_FIXERS = {
+    dict: lambda raw: raw,
+    str: _parse_raw_str,
+}
+
+
+# Small-vocabulary meta fields repeated across cases; interning makes equal
+# values share one str (also deduplicated by pickle in the disk cache).
+INTERNED_META_KEYS = ("relationship_type", "role1", "role2")
+
 def normalize_case(c: dict, idx: int) -> dict:
     if not isinstance(c, dict):
         c = {}
@@ -66,26 +117,28 @@ def normalize_case(c: dict, idx: int) -> dict:
         meta.setdefault("role1", p1.get("role"))
         meta.setdefault("role2", p2.get("role"))
 
+    for k in INTERNED_META_KEYS:
+        v = meta.get(k)
+        if type(v) is str:
+            meta[k] = sys.intern(v)
+
     top_level_script = c.get("script", [])
     raw = c.get("raw")
 
-    if isinstance(raw, str):
-        try:
-            raw = json.loads(raw)
-        except json.JSONDecodeError:
-            raw = {}
-    elif raw is None:
-        raw = {}
-    elif not isinstance(raw, dict):
-        raw = {}
-
-    if not isinstance(top_level_script, list):
-        top_level_script = []
-
-    script = raw.get("script", top_level_script)
-    if not isinstance(script, list):
-        script = top_level_script if isinstance(top_level_script, list) else []
-    raw["script"] = script
+    # Fast paths for well-formed lines (exact type checks, no MRO walk):
+    # the generator's top-level script with no raw, or raw already holding one.
+    if raw is None and type(top_level_script) is list:
+        raw = {"script": top_level_script}
+    elif not (type(raw) is dict and type(raw.get("script")) is list):
+        raw = _RAW_FIXERS.get(type(raw), _empty_raw)(raw)
+
+        if not isinstance(top_level_script, list):
+            top_level_script = []
+
+        script = raw.get("script", top_level_script)
+        if not isinstance(script, list):
+            script = top_level_script
+        raw["script"] = script
 
     c["meta"] = meta
     c["raw"] = raw
@@ -96,7 +149,7 @@ def normalize_case(c: dict, idx: int) -> dict:
     return c
 
 
-# Config
+# Config (paths stay str: they are cache keys for the loaders below)
 BASE_DIR = Path(__file__).resolve().parent
 DATA_PATH = str(BASE_DIR / "data" / "cases.jsonl")
 TUTORIAL_PATH = str(BASE_DIR / "data" / "tutorial.json")
@@ -109,25 +162,72 @@ POWER_SOURCE_TAGS = [
     "NORM/REPUTATION", "EMOTIONAL LEVERAGE", "COERCION", "COALITION"
 ]
 
+# Flattened record fields written by Save & Next, in CSV column order.
+EXPORT_CSV_COLUMNS = [
+    "case_id", "annotator", "timestamp", "winner",
+    "power_sources_s1", "power_sources_s2", "winner_reason", "tags_reason",
+    "meta_snapshot.relationship_type", "meta_snapshot.role1", "meta_snapshot.role2",
+    "meta_snapshot.name1", "meta_snapshot.name2",
+]
+
+PAGE_SIZE = 100  # cases per page in the sidebar case picker
+# Seconds a cached annotation read is reused. Saves made in this process bump
+# the annotator's cache generation, so this only bounds how long rows written
+# by other worker processes (or before a restart) can stay invisible.
+ANNOTATIONS_TTL = 300
+# Seconds the writer waits to batch queued saves. Rows go one per request only
+# while isolating a rejected batch; saves queued meanwhile form the next batch.
+WRITE_FLUSH_INTERVAL = 0.2
+WRITE_RETRY_DELAY = 5  # seconds before retrying a failed batch upsert
+# SQLSTATE classes worth retrying: connection, transaction rollback,
+# insufficient resources, operator intervention (timeouts), system error.
+TRANSIENT_SQLSTATE_CLASSES = ("08", "40", "53", "57", "58")
+
 
 # Utilities
-@st.cache_data
-def load_cases(path: str, mtime: float):
+def file_fingerprint(path: str) -> str:
+    """mtime + size of a file ("" if missing); changes whenever the file is edited."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return ""
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+@st.cache_data(persist="disk", show_spinner=False, max_entries=2, hash_funcs={Path: str})
+def load_cases(path: str, fingerprint: str):
+    """Return the case index: normalized cases without their scripts, each
+    with the byte "offset" of its line so load_script can read it on demand."""
+    # fingerprint is only part of the cache key, so editing the file
+    # invalidates both the in-memory and the on-disk cache entries.
+    # One read + C-level line split; idx must stay the physical line number
+    # because the idx_<n> fallback ids are derived from it.
+    with open(path, "rb") as f:
+        data = f.read()
     cases = []
-    with open(path, "r", encoding="utf-8") as f:
-        for idx, line in enumerate(f):
-            line = line.strip()
-            if not line:
-                continue
-            c = json.loads(line)
-            cases.append(normalize_case(c, idx))
+    offset = 0
+    for idx, line in enumerate(data.split(b"\n")):
+        if line.strip():
+            c = normalize_case(json_loads(line), idx)
+            del c["raw"]
+            c.pop("script", None)
+            c["offset"] = offset
+            cases.append(c)
+        offset += len(line) + 1
     return cases
 
-def load_tutorial(path: str) -> list:
+def load_script(path: str, offset: int) -> list:
+    """Read the case line starting at offset and return its normalized script."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        line = f.readline()
+    return normalize_case(json_loads(line), 0)["raw"]["script"]
+
+@st.cache_data(persist="disk", show_spinner=False, hash_funcs={Path: str})
+def load_tutorial(path: str, fingerprint: str) -> list:
     if not os.path.exists(path):
         return []
-    with open(path, "r", encoding="utf-8") as f:
-        obj = json.load(f)
+    with open(path, "rb") as f:
+        obj = json_loads(f.read())
     if isinstance(obj, dict) and isinstance(obj.get("steps"), list):
         return obj["steps"]
     raise ValueError("tutorial.json must be a JSON object with a top-level 'steps' list.")
@@ -144,7 +244,22 @@ def get_supabase():
         st.stop()
     return create_client(url, key)
 
-def load_existing_annotations(annotator: str):
+@st.cache_resource
+def get_write_state() -> dict:
+    """Process-wide state shared by every session and the writer thread:
+    a per-annotator generation number that is part of the annotation cache
+    keys, so bumping it makes the next read go back to Supabase."""
+    return {"lock": threading.Lock(), "generation": {}}
+
+def bump_generation(state: dict, annotator: str):
+    with state["lock"]:
+        state["generation"][annotator] = state["generation"].get(annotator, 0) + 1
+
+def annotation_generation(annotator: str) -> int:
+    return get_write_state()["generation"].get(annotator, 0)
+
+@st.cache_data(ttl=ANNOTATIONS_TTL, show_spinner=False)
+def load_existing_annotations(annotator: str, generation: int):
     """Return dict: case_id -> record(payload) for this annotator"""
     sb = get_supabase()
     res = (
@@ -156,16 +271,190 @@ def load_existing_annotations(annotator: str):
     rows = res.data or []
     return {r["case_id"]: r["payload"] for r in rows}
 
-def upsert_annotation(case_id: str, annotator: str, payload: dict):
-    """Insert/update one annotation in Supabase."""
+@st.cache_data(ttl=ANNOTATIONS_TTL, show_spinner=False)
+def load_annotation_ids(annotator: str, generation: int) -> frozenset:
+    """Return the case_ids this annotator has saved (no payloads)."""
+    sb = get_supabase()
+    res = (
+        sb.table("annotations")
+        .select("case_id")
+        .eq("annotator", annotator)
+        .execute()
+    )
+    return frozenset(r["case_id"] for r in res.data or [])
+
+@st.cache_data(ttl=ANNOTATIONS_TTL, show_spinner=False)
+def load_annotation_record(annotator: str, case_id: str, generation: int):
+    """Return the saved record(payload) for one case, or None."""
+    sb = get_supabase()
+    res = (
+        sb.table("annotations")
+        .select("payload")
+        .eq("annotator", annotator)
+        .eq("case_id", case_id)
+        .limit(1)
+        .execute()
+    )
+    rows = res.data or []
+    return rows[0]["payload"] if rows else None
+
+def is_transient_write_error(exc: Exception) -> bool:
+    """True for upsert failures worth retrying: network errors, timeouts,
+    rate limits and server-side errors. Only a definite client error (RLS,
+    constraint, bad value) is final, since it would fail the same way again."""
+    if isinstance(exc, httpx.TransportError):
+        return True
+    if isinstance(exc, APIError):
+        # The HTTP status if the body wasn't JSON, else a SQLSTATE or PGRSTxxx
+        # code; a gateway error (e.g. a rate limit) may carry no code at all.
+        code = str(exc.code or "")
+        if len(code) == 3 and code.isdigit():
+            return code.startswith("5") or code in ("408", "429")
+        if code.startswith("PGRST"):
+            return code.startswith("PGRST00")  # PGRST000-003: database unreachable
+        if len(code) == 5:
+            return code[:2] in TRANSIENT_SQLSTATE_CLASSES
+        return True
+    return False  # not a Supabase error: a bug in the row won't fix itself
+
+@st.cache_resource
+def get_annotation_writer() -> queue.Queue:
+    """Start the write-behind thread (once per process) and return its queue.
+
+    Items are (row, failures) pairs; rows are upserted to Supabase in
+    batches, so a save click never waits on the network. Transient errors
+    are retried. If Supabase rejects a batch, its rows are written one by
+    one and each rejected row is dropped and appended, with the error, to
+    the failures list of the session that saved it.
+
+    The queue lives only in this process: rows still queued or waiting for
+    a retry are lost if the worker restarts and the daemon thread dies.
+    """
     sb = get_supabase()
+    state = get_write_state()
+    q = queue.Queue()
+
+    def upsert(rows):
+        (
+            sb.table("annotations")
+            .upsert(
+                rows,
+                on_conflict="case_id,annotator",
+                returning="minimal",  # don't echo the batch back
+            )
+            .execute()
+        )
+
+    def flush_loop():
+        pending = {}  # (case_id, annotator) -> latest (row, failures); a batch can't repeat a key
+        while True:
+            if not pending:
+                row, failures = q.get()
+                pending[(row["case_id"], row["annotator"])] = (row, failures)
+            time.sleep(WRITE_FLUSH_INTERVAL)  # let rapid saves coalesce
+            while not q.empty():
+                row, failures = q.get_nowait()
+                pending[(row["case_id"], row["annotator"])] = (row, failures)
+            try:
+                upsert([row for row, _ in pending.values()])
+                done = list(pending)
+            except Exception as exc:
+                done = []
+                if not is_transient_write_error(exc):
+                    # Isolate the rejected rows so they don't block the rest.
+                    for key, (row, failures) in pending.items():
+                        try:
+                            upsert([row])
+                        except Exception as row_exc:
+                            if is_transient_write_error(row_exc):
+                                continue
+                            logger.error("Dropping rejected annotation %s: %s", key, row_exc)
+                            failures.append((row, row_exc))
+                        done.append(key)
+                if len(done) < len(pending):
+                    # Keep the rest; newer saves for the same case still win.
+                    logger.warning(
+                        "Annotation upsert failed; retrying %d rows",
+                        len(pending) - len(done), exc_info=exc,
+                    )
+            for key in done:
+                del pending[key]
+            # A read that ran between queueing and now may have cached a
+            # result without these rows; move their annotators past it.
+            for annotator in {a for _, a in done}:
+                bump_generation(state, annotator)
+            if pending:
+                time.sleep(WRITE_RETRY_DELAY)
+
+    threading.Thread(target=flush_loop, name="annotation-writer", daemon=True).start()
+    return q
+
+def upsert_annotation(case_id: str, annotator: str, payload: dict):
+    """Queue one annotation for Supabase and remember it as this session's save."""
     row = {
         "case_id": case_id,
         "annotator": annotator,
         "payload": payload,
         "updated_at": datetime.utcnow().isoformat(),
     }
-    sb.table("annotations").upsert(row, on_conflict="case_id,annotator").execute()
+    get_annotation_writer().put((row, st.session_state.write_failures))
+    st.session_state.ann_records.setdefault(annotator, {})[case_id] = payload
+
+def report_write_failures():
+    """Show saves the writer had to drop, and stop counting or exporting them."""
+    failures = st.session_state.write_failures
+    while failures:
+        row, exc = failures.pop(0)
+        saved = st.session_state.ann_records.get(row["annotator"], {})
+        if saved.get(row["case_id"]) is not row["payload"]:
+            continue  # re-saved since; the newer row reports its own failure
+        del saved[row["case_id"]]
+        st.error(f"Annotation for case {row['case_id']} was not saved: {exc}")
+
+def get_annotated_ids(annotator: str) -> frozenset:
+    """Annotated case_ids: the cached Supabase set plus this session's saves
+    (which may still be waiting in the write-behind queue)."""
+    ids = load_annotation_ids(annotator, annotation_generation(annotator))
+    return ids.union(st.session_state.ann_records.get(annotator, {}))
+
+def get_export_rows(annotator: str) -> list:
+    """All saved records for annotator: the cached fetch, overlaid with this
+    session's saves (which may still be waiting in the write-behind queue)."""
+    rows = load_existing_annotations(annotator, annotation_generation(annotator))
+    rows.update(st.session_state.ann_records.get(annotator, {}))
+    return list(rows.values())
+
+def flatten_record(rec: dict, prefix: str = "") -> dict:
+    """Flatten nested dicts into dotted keys (meta_snapshot.name1, ...)."""
+    out = {}
+    for k, v in rec.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(flatten_record(v, f"{key}."))
+        else:
+            out[key] = v
+    return out
+
+def rows_to_csv(rows: list) -> bytes:
+    """CSV export: EXPORT_CSV_COLUMNS first, then any other keys older
+    records carry, in first-seen order."""
+    flat = [flatten_record(r) for r in rows]
+    fieldnames = list(dict.fromkeys([*EXPORT_CSV_COLUMNS, *(k for r in flat for k in r)]))
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=fieldnames, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(flat)
+    return buf.getvalue().encode("utf-8")
+
+def get_annotation_record(annotator: str, case_id: str):
+    """Saved record for one case: this session's own save if it made one,
+    else the cached Supabase row (None if the case isn't annotated)."""
+    saved = st.session_state.ann_records.get(annotator, {})
+    if case_id in saved:
+        return saved[case_id]
+    if case_id not in get_annotated_ids(annotator):
+        return None
+    return load_annotation_record(annotator, case_id, annotation_generation(annotator))
 
 def do_save():
     winner_reason = st.session_state.get(f"winner_reason_{case_id}", "")
@@ -191,13 +480,18 @@ def do_save():
     }
     upsert_annotation(case_id, st.session_state.annotator, record)
 
-def go_next():
-    st.session_state.case_idx = min(st.session_state.case_idx + 1, len(cases) - 1)
+def set_case_idx(idx: int):
+    """Move to case idx, re-sync the sidebar picker and mirror it in ?i= so
+    a full page reload reopens the same case."""
+    st.session_state.case_idx = max(0, min(idx, len(cases) - 1))
     st.session_state._sync_jump = True
+    st.query_params["i"] = str(st.session_state.case_idx)
+
+def go_next():
+    set_case_idx(st.session_state.case_idx + 1)
 
 def go_prev():
-    st.session_state.case_idx = max(st.session_state.case_idx - 1, 0)
-    st.session_state._sync_jump = True
+    set_case_idx(st.session_state.case_idx - 1)
 
 def save_and_next():
     do_save()
@@ -205,6 +499,32 @@ def save_and_next():
     st.rerun()
 
 
+ANNOTATED_MARK = "✅ "
+UNANNOTATED_MARK = "⬜ "
+
+@st.cache_data(show_spinner=False)
+def case_columns(_cases: list, fingerprint: str):
+    """Hot per-case fields as parallel tuples: (ids, relationship types, id set).
+
+    _cases is not hashed; fingerprint (of the cases file) is the cache key.
+    """
+    case_ids = tuple(c.get("id", f"idx_{i}") for i, c in enumerate(_cases))
+    case_rels = tuple(
+        (c.get("meta", {}) or {}).get("relationship_type", "Unknown") for c in _cases
+    )
+    return case_ids, case_rels, frozenset(case_ids)
+
+@st.cache_data(show_spinner=False)
+def build_static_labels(_case_ids: tuple, _case_rels: tuple, fingerprint: str):
+    """Jump-to-case labels without the annotated mark, plus a case_id -> case
+    index map."""
+    labels = [
+        f"[{i:05d}] {cid} ({rel})"
+        for i, (cid, rel) in enumerate(zip(_case_ids, _case_rels))
+    ]
+    return labels, {cid: i for i, cid in enumerate(_case_ids)}
+
+
 def case_option_label(case, existing_dict):
     cid = case.get("id", "unknown")
     rel = (case.get("meta", {}) or {}).get("relationship_type", "Unknown")
@@ -212,11 +532,18 @@ def case_option_label(case, existing_dict):
     return f"{mark} {cid} ({rel})"
 
 
-def render_script(script):
-    for t in script:
-        speaker = t.get("speaker", "Unknown")
-        text = t.get("text", "")
-        st.markdown(f"**{speaker}:** {text}")
+@st.cache_data(show_spinner=False, max_entries=64, hash_funcs={Path: str})
+def script_markdown(path: str, fingerprint: str, offset: int) -> str:
+    """One case's conversation as a single markdown blob, keyed by the case's
+    line offset so reruns hash three small args instead of the script."""
+    return "\n\n".join(
+        f"**{t.get('speaker', 'Unknown')}:** {t.get('text', '')}"
+        for t in load_script(path, offset)
+    )
+
+def render_script(path: str, fingerprint: str, offset: int):
+    # One st.markdown element for the whole conversation, not one per turn.
+    st.markdown(script_markdown(path, fingerprint, offset))
 
 def get_case_display_name(case):
     cid = case.get("id", "unknown")
@@ -229,40 +556,46 @@ def render_conversation(conv):
         text = turn.get("text", "")
         st.markdown(f"**{speaker}:** {text}")
 
-def render_tag_reference(step):
-    st.write(step.get("title", "Power Source Tags"))
-    groups = step.get("groups", [])
-    for g in groups:
-        st.subheader(g.get("group", ""))
+def _html_list(items) -> str:
+    if isinstance(items, str):
+        items = [items]
+    return "<ul>" + "".join(f"<li>{escape(str(x))}</li>" for x in items) + "</ul>"
+
+@st.cache_data(show_spinner=False)
+def tag_reference_markdown(step: dict) -> str:
+    """The whole tag reference as one markdown blob, one <details> per tag."""
+    parts = [escape(step.get("title", "Power Source Tags"))]
+    for g in step.get("groups", []):
+        parts.append(f"### {g.get('group', '')}")
         for t in g.get("tags", []):
-            with st.expander(t["tag"]):
-                st.markdown(f"**Definition:** {t.get('definition','')}")
-
-                cues = t.get("cues", [])
-                use_when = t.get("use_when", t.get("Use when", []))
-                dont_use_when = t.get("dont_use_when", t.get("Do not use when", []))
-
-                if cues:
-                    st.markdown("**Common cues:**")
-                    st.markdown("\n".join([f"- {c}" for c in cues]))
-
-                if use_when:
-                    st.markdown("**Use when:**")
-                    if isinstance(use_when, str):
-                        st.markdown(f"- {use_when}")
-                    else:
-                        st.markdown("\n".join([f"- {x}" for x in use_when]))
-
-                if dont_use_when:
-                    st.markdown("**Do not use when:**")
-                    if isinstance(dont_use_when, str):
-                        st.markdown(f"- {dont_use_when}")
-                    else:
-                        st.markdown("\n".join([f"- {x}" for x in dont_use_when]))
-
-                ex = t.get("mini_example")
-                if ex:
-                    st.markdown(f"**Mini example:** {ex}")
+            # No blank lines inside: each <details> must stay one HTML block.
+            body = [f"<p><b>Definition:</b> {escape(t.get('definition', ''))}</p>"]
+
+            cues = t.get("cues", [])
+            use_when = t.get("use_when", t.get("Use when", []))
+            dont_use_when = t.get("dont_use_when", t.get("Do not use when", []))
+
+            if cues:
+                body.append("<p><b>Common cues:</b></p>" + _html_list(cues))
+            if use_when:
+                body.append("<p><b>Use when:</b></p>" + _html_list(use_when))
+            if dont_use_when:
+                body.append("<p><b>Do not use when:</b></p>" + _html_list(dont_use_when))
+
+            ex = t.get("mini_example")
+            if ex:
+                body.append(f"<p><b>Mini example:</b> {escape(ex)}</p>")
+
+            parts.append(
+                f"<details><summary><b>{escape(t['tag'])}</b></summary>"
+                + "".join(body)
+                + "</details>"
+            )
+    return "\n\n".join(parts)
+
+def render_tag_reference(step):
+    # One element instead of an expander + several markdown calls per tag.
+    st.markdown(tag_reference_markdown(step), unsafe_allow_html=True)
 
 def render_content(step):
     st.header(step.get("title", ""))
@@ -312,43 +645,87 @@ def render_walkthrough(step):
         else:
             st.markdown(f"**Why:** {rationale}")
 
-def render_tag_checkboxes(title, tags, default_selected, key_prefix, n_cols=1):
-    st.markdown(f"**{title}**")
-    selected = []
+def render_tag_multiselect(title, tags, default_selected, key):
+    # One widget per speaker instead of one checkbox per tag.
+    if key not in st.session_state:
+        st.session_state[key] = [t for t in (default_selected or []) if t in tags]
+    return st.multiselect(title, options=tags, key=key)
 
-    cols = st.columns(n_cols) if n_cols and n_cols > 1 else None
+@st.fragment
+def render_tutorial(steps):
+    # Back/Next rerun only this fragment, not the sidebar and data loading.
+    step = max(0, min(st.session_state.tutorial_step, len(steps) - 1))
+    st.session_state.tutorial_step = step
+    item = steps[step]
 
-    for i, t in enumerate(tags):
-        k = f"{key_prefix}_{t}"
-        if k not in st.session_state:
-            st.session_state[k] = (t in (default_selected or []))
+    t = item.get("type", "content")
 
-        if cols is None:
-            v = st.checkbox(t, key=k)
-        else:
-            with cols[i % n_cols]:
-                v = st.checkbox(t, key=k)
+    if t == "content":
+        render_content(item)
 
-        if v:
-            selected.append(t)
+    elif t == "tag_reference":
+        render_tag_reference(item)
 
-    return selected
+    elif t == "walkthrough":
+        render_walkthrough(item)
 
-def get_selected_tags_from_state(tags, key_prefix):
-    out = []
-    for t in tags:
-        if st.session_state.get(f"{key_prefix}_{t}", False):
-            out.append(t)
-    return out
+    else:
+        st.warning(f"Unknown tutorial step type: {t}")
+        st.json(item)
+
+    c1, c2, c3 = st.columns([1, 1, 3])
+    with c1:
+        if st.button("⬅️ Back", key=f"tut_back_{step}", disabled=(step == 0)):
+            st.session_state.tutorial_step = step - 1
+            st.rerun(scope="fragment")
+    with c2:
+        if st.button("Next ➡️", key=f"tut_next_{step}", disabled=(step == len(steps) - 1)):
+            st.session_state.tutorial_step = step + 1
+            st.rerun(scope="fragment")
+    with c3:
+        st.caption(f"Progress: {step+1}/{len(steps)}")
+
+    if step == len(steps) - 1:
+        if st.button("Proceed to Annotation", key="tut_to_annotate"):
+            st.session_state.mode = "Annotate"
+            st.rerun()  # mode change needs the full app
+
+@st.fragment
+def render_tag_panel(case_id, name1, name2, prev):
+    # Tag edits rerun only this panel; Save & Next reads the keys from session_state.
+    st.markdown("### Power source tags")
+
+    default_s1 = prev.get("power_sources_s1", []) if prev else []
+    default_s2 = prev.get("power_sources_s2", []) if prev else []
+
+    render_tag_multiselect(
+        title=f"{name1}",
+        tags=POWER_SOURCE_TAGS,
+        default_selected=default_s1,
+        key=f"tags_s1_{case_id}",
+    )
+    render_tag_multiselect(
+        title=f"{name2}",
+        tags=POWER_SOURCE_TAGS,
+        default_selected=default_s2,
+        key=f"tags_s2_{case_id}",
+    )
 
 if "mode" not in st.session_state:
     st.session_state.mode = "Tutorial"
 if "case_idx" not in st.session_state:
-    st.session_state.case_idx = 0
+    try:
+        st.session_state.case_idx = int(st.query_params.get("i", 0))
+    except ValueError:
+        st.session_state.case_idx = 0
 if "tutorial_step" not in st.session_state:
     st.session_state.tutorial_step = 0
 if "annotator" not in st.session_state:
     st.session_state.annotator = "Harley"
+if "ann_records" not in st.session_state:
+    st.session_state.ann_records = {}  # annotator -> {case_id: record} saved in this session
+if "write_failures" not in st.session_state:
+    st.session_state.write_failures = []  # (row, error) the writer dropped; see report_write_failures
 
 
 # Sidebar
@@ -406,14 +783,17 @@ even if not explicit crying/pleading.
 st.sidebar.divider()
 
 # Progress
-cases = load_cases(DATA_PATH, os.path.getmtime(DATA_PATH))
-current_case_ids = {c.get("id", f"idx_{i}") for i, c in enumerate(cases)}
+cases_fp = file_fingerprint(DATA_PATH)
+cases = load_cases(DATA_PATH, cases_fp)
+case_ids, case_rels, current_case_ids = case_columns(cases, cases_fp)
 
-existing_all = load_existing_annotations(st.session_state.annotator)
-existing = {cid: rec for cid, rec in existing_all.items() if cid in current_case_ids}
+report_write_failures()  # before counting, so dropped saves aren't shown as done
+existing = get_annotated_ids(st.session_state.annotator) & current_case_ids
 
 total = len(cases)
 done = len(existing)
+# ?i= comes from the URL, and the cases file may have shrunk since.
+st.session_state.case_idx = max(0, min(st.session_state.case_idx, total - 1))
 
 st.sidebar.subheader("Progress")
 st.sidebar.metric("Annotated", done)
@@ -436,74 +816,117 @@ if st.session_state.mode == "Annotate":
     st.sidebar.subheader("Jump to Case")
     show_only_unannotated = st.sidebar.checkbox("Show only unannotated", value=False)
 
-    def make_label(i, case):
-        cid = case.get("id", f"idx_{i}")
-        rel = (case.get("meta", {}) or {}).get("relationship_type", "Unknown")
-        mark = "✅" if cid in existing else "⬜"
-        return f"{mark} [{i:05d}] {cid} ({rel})"
-
-    full_labels = [make_label(i, c) for i, c in enumerate(cases)]
-    label_to_idx = {lab: i for i, lab in enumerate(full_labels)}
+    static_labels, id_to_idx = build_static_labels(case_ids, case_rels, cases_fp)
 
+    # Case indices offered by the picker, ascending. Only one page of them
+    # is turned into labels and sent to the selectbox.
+    pool = range(total)
     if show_only_unannotated:
-        labels = [lab for i, lab in enumerate(full_labels) if cases[i].get("id") not in existing]
-        if not labels:
+        pool = [i for i, cid in enumerate(case_ids) if cid not in existing]
+        if not pool:
             st.sidebar.info("All cases annotated.")
-            labels = full_labels
-    else:
-        labels = full_labels
+            pool = range(total)
+    n_pages = max(1, -(-len(pool) // PAGE_SIZE))
 
-    current_label = full_labels[st.session_state.case_idx]
-    if current_label not in labels:
-        current_label = labels[0]
+    # Where the current case sits in pool (None if filtered out); the page
+    # picker falls back to the first page then.
+    pos = bisect_left(pool, st.session_state.case_idx)
+    if pos >= len(pool) or pool[pos] != st.session_state.case_idx:
+        pos = None
 
     if "_sync_jump" not in st.session_state:
         st.session_state._sync_jump = False
 
-    if "jump_case" not in st.session_state:
-        st.session_state.jump_case = current_label
-    if st.session_state._sync_jump:
+    # Re-home the page on navigation and when the filter changes the pool.
+    if (
+        "jump_page" not in st.session_state
+        or st.session_state._sync_jump
+        or st.session_state.get("_jump_filter") != show_only_unannotated
+    ):
+        st.session_state.jump_page = (pos or 0) // PAGE_SIZE + 1
+        st.session_state._sync_jump = True
+    st.session_state._jump_filter = show_only_unannotated
+    st.session_state.jump_page = min(st.session_state.jump_page, n_pages)
+
+    page = st.sidebar.number_input(
+        "Page",
+        min_value=1,
+        max_value=n_pages,
+        step=1,
+        key="jump_page",
+    )
+    page_start = (page - 1) * PAGE_SIZE
+    page_idx = pool[page_start:page_start + PAGE_SIZE]
+    labels = [
+        (ANNOTATED_MARK if case_ids[i] in existing else UNANNOTATED_MARK) + static_labels[i]
+        for i in page_idx
+    ]
+    page_label_to_idx = dict(zip(labels, page_idx))
+
+    # Browsing to a page without the current case shows no selection rather
+    # than selecting another case; only an explicit pick moves.
+    if pos is not None and page_start <= pos < page_start + len(labels):
+        current_label = labels[pos - page_start]
+    else:
+        current_label = None
+
+    if st.session_state._sync_jump or st.session_state.get("jump_case") not in page_label_to_idx:
         st.session_state.jump_case = current_label
-        st.session_state._sync_jump = False
+    st.session_state._sync_jump = False
 
     chosen = st.sidebar.selectbox(
         "Case",
         options=labels,
         key="jump_case",
+        placeholder="Pick a case on this page",
     )
 
-    new_idx = label_to_idx.get(chosen, st.session_state.case_idx)
-    if new_idx != st.session_state.case_idx:
-        st.session_state.case_idx = new_idx
+    new_idx = page_label_to_idx.get(chosen)
+    if new_idx is not None and new_idx != st.session_state.case_idx:
+        set_case_idx(new_idx)
         st.rerun()
 
+    def on_jump_id():
+        cid = st.session_state.jump_id.strip()
+        if cid in id_to_idx:
+            set_case_idx(id_to_idx[cid])
+            st.session_state.jump_id = ""
+        elif cid:
+            st.session_state._jump_id_error = f"No case with id '{cid}'."
+
+    st.sidebar.text_input("Go to case id", key="jump_id", on_change=on_jump_id)
+    if "_jump_id_error" in st.session_state:
+        st.sidebar.warning(st.session_state.pop("_jump_id_error"))
+
 st.sidebar.divider()
 
 # Export
 st.sidebar.subheader("Export Annotations")
 
 if st.sidebar.button("⬇️ Download JSONL"):
-    rows = list(load_existing_annotations(st.session_state.annotator).values())
+    rows = get_export_rows(st.session_state.annotator)
     if not rows:
         st.sidebar.info("No annotations yet.")
     else:
-        jsonl = "\n".join(json.dumps(r, ensure_ascii=False) for r in rows) + "\n"
+        buf = io.BytesIO()
+        for r in rows:
+            buf.write(json_dumps_bytes(r))
+            buf.write(b"\n")
         st.sidebar.download_button(
             label="Click to download",
-            data=jsonl.encode("utf-8"),
+            data=buf.getvalue(),
             file_name=f"{st.session_state.annotator}.jsonl",
             mime="application/jsonl",
         )
 
 if st.sidebar.button("⬇️ Download CSV"):
-    rows = list(load_existing_annotations(st.session_state.annotator).values())
+    rows = get_export_rows(st.session_state.annotator)
     if not rows:
         st.sidebar.info("No annotations yet.")
     else:
-        df = pd.json_normalize(rows)
         st.sidebar.download_button(
             label="Click to download",
-            data=df.to_csv(index=False).encode("utf-8"),
+            data=rows_to_csv(rows),
             file_name=f"{st.session_state.annotator}.csv",
             mime="text/csv",
         )
@@ -516,7 +939,7 @@ if st.session_state.mode == "Tutorial":
     st.caption("Learn by exploring a few examples before annotation.")
 
     try:
-        steps = load_tutorial(TUTORIAL_PATH)
+        steps = load_tutorial(TUTORIAL_PATH, file_fingerprint(TUTORIAL_PATH))
     except Exception as e:
         st.error(f"Failed to load tutorial.json: {e}")
         st.stop()
@@ -525,44 +948,7 @@ if st.session_state.mode == "Tutorial":
         st.info("No steps found in tutorial.json.")
         st.stop()
 
-    if "tutorial_step" not in st.session_state:
-        st.session_state.tutorial_step = 0
-
-    step = max(0, min(st.session_state.tutorial_step, len(steps) - 1))
-    st.session_state.tutorial_step = step
-    item = steps[step]
-
-    t = item.get("type", "content")
-
-    if t == "content":
-        render_content(item)
-
-    elif t == "tag_reference":
-        render_tag_reference(item)
-
-    elif t == "walkthrough":
-        render_walkthrough(item)
-
-    else:
-        st.warning(f"Unknown tutorial step type: {t}")
-        st.json(item)
-
-    c1, c2, c3 = st.columns([1, 1, 3])
-    with c1:
-        if st.button("⬅️ Back", key=f"tut_back_{step}", disabled=(step == 0)):
-            st.session_state.tutorial_step = step - 1
-            st.rerun()
-    with c2:
-        if st.button("Next ➡️", key=f"tut_next_{step}", disabled=(step == len(steps) - 1)):
-            st.session_state.tutorial_step = step + 1
-            st.rerun()
-    with c3:
-        st.caption(f"Progress: {step+1}/{len(steps)}")
-
-    if step == len(steps) - 1:
-        if st.button("Proceed to Annotation", key="tut_to_annotate"):
-            st.session_state.mode = "Annotate"
-            st.rerun()
+    render_tutorial(steps)
 
 else:
     # Annotate mode
@@ -579,20 +965,15 @@ else:
     winner_reason, tags_reason = "", ""
 
     col_left, col_right = st.columns([2.2, 1], gap="large")
-    prev = existing.get(case_id)
+    prev = get_annotation_record(st.session_state.annotator, case_id)
 
     with col_left:
         st.markdown("### Conversation")
-        script = case.get("raw", {}).get("script", [])
-        render_script(script)
-
-        prev = existing.get(case_id)
+        render_script(DATA_PATH, cases_fp, case["offset"])
 
         st.markdown("### Winner")
 
-        # Pre-fill if already annotated
-        prev = existing.get(case_id)
-
+        # Pre-fill if already annotated (prev is fetched above)
         # winner
         winner_options = ["Tie", name1, name2]
         default_winner = "Tie"
@@ -658,14 +1039,13 @@ else:
         c1, c2 = st.columns(2)
         with c1:
             if st.button("⬅️ Previous", key=f"nav_prev_{case_id}", disabled=(st.session_state.case_idx == 0)):
-                st.session_state.case_idx = max(st.session_state.case_idx - 1, 0)
-                st.session_state._sync_jump = True
+                go_prev()
                 st.rerun()
 
         with c2:
             if st.button("✅ Save & Next ➡️", type="primary", key=f"save_next_{case_id}"):
-                tags_s1 = get_selected_tags_from_state(POWER_SOURCE_TAGS, key_prefix=f"s1_{case_id}")
-                tags_s2 = get_selected_tags_from_state(POWER_SOURCE_TAGS, key_prefix=f"s2_{case_id}") 
+                tags_s1 = list(st.session_state.get(f"tags_s1_{case_id}", []))
+                tags_s2 = list(st.session_state.get(f"tags_s2_{case_id}", []))
                 record = {
                 "case_id": case_id,
                 "annotator": st.session_state.annotator,
@@ -685,35 +1065,13 @@ else:
                 }
                 upsert_annotation(case_id, st.session_state.annotator, record)
 
-                st.session_state.case_idx = min(st.session_state.case_idx + 1, len(cases) - 1)
-                st.session_state._sync_jump = True
+                go_next()
                 st.rerun()
 
 
 
     with col_right:
-        st.markdown("### Power source tags")
-
-        default_s1 = prev.get("power_sources_s1", []) if prev else []
-        default_s2 = prev.get("power_sources_s2", []) if prev else []
-
-        cA, cB = st.columns(2, gap="large")
-        with cA:
-            _ = render_tag_checkboxes(
-                title=f"{name1}",
-                tags=POWER_SOURCE_TAGS,
-                default_selected=default_s1,
-                key_prefix=f"s1_{case_id}", 
-                n_cols=1
-            )
-        with cB:
-            _ = render_tag_checkboxes(
-                title=f"{name2}",
-                tags=POWER_SOURCE_TAGS,
-                default_selected=default_s2,
-                key_prefix=f"s2_{case_id}",
-                n_cols=1
-            )
+        render_tag_panel(case_id, name1, name2, prev)
 
 
     # Small footer progress